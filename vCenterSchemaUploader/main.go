@@ -2,27 +2,65 @@ package main
 
 import (
 	"bytes"
+	"compress/gzip"
+	"context"
 	"encoding/json"
+	"errors"
 	"flag"
 	"fmt"
-	"io/ioutil"
+	"io"
 	"log"
+	"net"
 	"net/http"
+	"net/url"
 	"os"
+	"os/signal"
+	"reflect"
+	"strconv"
 	"strings"
+	"sync"
 	"time"
 )
 
+// maxParallelDeletes bounds concurrent DELETE requests during a reset and
+// sizes the idle connection pool to match.
+const maxParallelDeletes = 16
+
+const userAgent = "vCenterSchemaUploader/1.0"
+
+// Transient failures are retried up to maxRetries times with exponential
+// backoff starting at retryBackoff. A Retry-After header is honoured up to
+// maxRetryAfter, and no retry starts once maxRetryElapsed has passed since
+// the first attempt.
+const (
+	maxRetries      = 4
+	retryBackoff    = 250 * time.Millisecond
+	maxRetryAfter   = 5 * time.Second
+	maxRetryElapsed = 15 * time.Second
+)
+
+// Every request is bounded so an unreachable BloodHound never hangs the
+// tool; logout is best-effort and gets a much shorter budget.
+const (
+	connectTimeout = 3 * time.Second
+	requestTimeout = 30 * time.Second
+	logoutTimeout  = 1500 * time.Millisecond
+)
+
 func main() {
 	serverPtr := flag.String("s", "", "BloodHound URL (e.g. http://localhost:8080)")
 	userPtr := flag.String("u", "", "Username")
 	passPtr := flag.String("p", "", "Password")
 	modelPtr := flag.String("model", "model.json", "Path to model.json file")
+	resetPtr := flag.Bool("reset", false, "Delete existing custom node kinds that are stale or changed, then upload only missing or changed kinds")
+	gzipPtr := flag.Bool("gzip", false, "Send the model with Content-Encoding: gzip")
+	quietPtr := flag.Bool("q", false, "Suppress progress output; errors are still printed")
 
 	// Support long flags too
 	flag.StringVar(serverPtr, "server", "", "BloodHound URL")
 	flag.StringVar(userPtr, "username", "", "Username")
 	flag.StringVar(passPtr, "password", "", "Password")
+	flag.BoolVar(resetPtr, "reset-custom-nodes", false, "Delete existing custom node kinds that are stale or changed, then upload only missing or changed kinds")
 
 	flag.Parse()
 
@@ -32,45 +70,119 @@ func main() {
 		os.Exit(1)
 	}
 
+	if *quietPtr {
+		log.SetOutput(io.Discard)
+	}
+
+	// Ctrl-C cancels in-flight requests instead of waiting them out.
+	ctx, stop := signal.NotifyContext(context.Background(), os.Interrupt)
+	defer stop()
+
 	log.Println("Starting Schema Upload...")
-	err := UploadSchema(*serverPtr, *userPtr, *passPtr, *modelPtr)
+	err := UploadSchema(ctx, *serverPtr, *userPtr, *passPtr, *modelPtr, UploadOptions{
+		Reset: *resetPtr,
+		Gzip:  *gzipPtr,
+	})
 	if err != nil {
-		log.Fatalf("Error: %v", err)
+		// Written directly so errors are reported even with -q.
+		fmt.Fprintf(os.Stderr, "Error: %v\n", err)
+		stop()
+		os.Exit(1)
 	}
 	log.Println("Done.")
 }
 
-// UploadSchema authenticates and uploads the model file to BloodHound
-func UploadSchema(baseURL, username, password, modelPath string) error {
+// UploadOptions controls optional UploadSchema behaviour.
+type UploadOptions struct {
+	// Reset deletes existing custom node kinds that are missing from the
+	// model or whose config differs from it, and then uploads only the
+	// kinds that are missing or changed. Without it the whole model is
+	// posted as-is.
+	Reset bool
+	// Gzip compresses the model upload. The server, or a proxy in front of
+	// it, must accept Content-Encoding: gzip request bodies.
+	Gzip bool
+}
+
+// UploadSchema authenticates and uploads the model file to BloodHound.
+// Cancelling ctx aborts in-flight requests and skips the logout.
+func UploadSchema(ctx context.Context, baseURL, username, password, modelPath string, opts UploadOptions) error {
 	// Ensure URL has protocol
 	if !strings.HasPrefix(baseURL, "http") {
 		baseURL = "http://" + baseURL
 	}
 	baseURL = strings.TrimRight(baseURL, "/")
 
-	client := &http.Client{
-		Timeout: 30 * time.Second,
+	// 1. Read Model
+	log.Printf("Reading model file: %s", modelPath)
+	// The file is read into a single buffer and, unless a reset finds kinds
+	// that are already up to date, sent verbatim without re-encoding.
+	modelData, err := os.ReadFile(modelPath)
+	if err != nil {
+		return fmt.Errorf("failed to read model file: %v", err)
 	}
+	desired, err := modelKinds(modelData)
+	if err != nil {
+		return fmt.Errorf("invalid model file %s: %v", modelPath, err)
+	}
+
+	// The HTTP client is only built once the model is known to be usable.
+	api := newAPIClient(baseURL)
 
-	// 1. Login
+	// 2. Login
 	log.Printf("Connecting to %s...", baseURL)
-	token, err := login(client, baseURL, username, password)
-	if err != nil {
+	if err := api.login(ctx, username, password); err != nil {
 		return fmt.Errorf("login failed: %v", err)
 	}
 	log.Println("Successfully authenticated with BloodHound")
+	defer func() {
+		// The server expires the token anyway, so don't spend a round trip
+		// on it after an interrupt.
+		if ctx.Err() != nil {
+			return
+		}
+		logoutCtx, cancel := context.WithTimeout(context.Background(), logoutTimeout)
+		defer cancel()
+		if err := api.logout(logoutCtx); err != nil {
+			log.Printf("Logout failed: %v", err)
+		}
+	}()
 
-	// 2. Read Model
-	log.Printf("Reading model file: %s", modelPath)
-	modelData, err := ioutil.ReadFile(modelPath)
-	if err != nil {
-		return fmt.Errorf("failed to read model file: %v", err)
+	// 3. Optional reset: stale and changed kinds are deleted, unchanged kinds
+	// are left alone and dropped from the upload
+	uploadData := modelData
+	if opts.Reset {
+		log.Println("Removing stale and changed custom node kinds...")
+		result, err := api.resetCustomNodes(ctx, desired)
+		if err != nil {
+			return fmt.Errorf("failed to list custom nodes: %v", err)
+		}
+		log.Printf("Deleted %d/%d stale or changed custom node kinds (%d existing, %d unchanged)",
+			result.deleted, result.outdated, result.existing, len(result.unchanged))
+		if err := ctx.Err(); err != nil {
+			return fmt.Errorf("reset interrupted: %v", err)
+		}
+		// Uploading over kinds that could not be deleted would collide
+		// with them, so a partial reset fails the run.
+		if result.deleted < result.outdated {
+			return fmt.Errorf("failed to delete %d of %d stale or changed custom node kinds",
+				result.outdated-result.deleted, result.outdated)
+		}
+
+		if len(result.unchanged) == len(desired) {
+			log.Println("All custom node kinds are up to date; nothing to upload")
+			return nil
+		}
+		if len(result.unchanged) > 0 {
+			if uploadData, err = withoutKinds(modelData, result.unchanged); err != nil {
+				return fmt.Errorf("failed to build upload: %v", err)
+			}
+		}
 	}
 
-	// 3. Upload
+	// 4. Upload
 	log.Println("Uploading custom nodes schema...")
-	err = upload(client, baseURL, token, modelData)
-	if err != nil {
+	if err := api.upload(ctx, uploadData, opts.Gzip); err != nil {
 		return fmt.Errorf("upload failed: %v", err)
 	}
 
@@ -78,27 +190,289 @@ func UploadSchema(baseURL, username, password, modelPath string) error {
 	return nil
 }
 
-func login(client *http.Client, baseURL, username, password string) (string, error) {
-	loginURL := baseURL + "/api/v2/login"
+// modelFile is the subset of model.json that is checked before upload.
+// Decoding into it parses and validates the shape in a single pass.
+type modelFile struct {
+	CustomTypes map[string]customType `json:"custom_types"`
+}
+
+type customType struct {
+	Icon struct {
+		Type  string `json:"type"`
+		Name  string `json:"name"`
+		Color string `json:"color"`
+	} `json:"icon"`
+
+	// raw is the kind's definition as written in the model, kept for
+	// comparing against the config the server reports.
+	raw json.RawMessage
+}
+
+func (t *customType) UnmarshalJSON(data []byte) error {
+	type plain customType
+	if err := json.Unmarshal(data, (*plain)(t)); err != nil {
+		return err
+	}
+	t.raw = append(json.RawMessage(nil), data...)
+	return nil
+}
+
+// modelKinds validates the model file and returns the custom node kinds it
+// defines, keyed by name. Errors name the offending kind and field.
+func modelKinds(data []byte) (map[string]customType, error) {
+	var model modelFile
+	if err := json.Unmarshal(data, &model); err != nil {
+		return nil, err
+	}
+
+	if len(model.CustomTypes) == 0 {
+		return nil, fmt.Errorf("custom_types is missing or empty")
+	}
+
+	for kind, def := range model.CustomTypes {
+		switch {
+		case kind == "":
+			return nil, fmt.Errorf("custom_types contains an empty kind name")
+		case def.Icon.Type == "":
+			return nil, fmt.Errorf("custom_types.%s.icon.type is required", kind)
+		case def.Icon.Name == "":
+			return nil, fmt.Errorf("custom_types.%s.icon.name is required", kind)
+		}
+	}
+
+	return model.CustomTypes, nil
+}
+
+// sameConfig reports whether the config the server holds for a kind matches
+// its definition in the model, ignoring formatting and key order.
+func sameConfig(model, server json.RawMessage) bool {
+	if len(server) == 0 {
+		return false
+	}
+
+	var a, b interface{}
+	if json.Unmarshal(model, &a) != nil || json.Unmarshal(server, &b) != nil {
+		return false
+	}
+	return reflect.DeepEqual(a, b)
+}
+
+// withoutKinds returns the model with the given kinds removed from
+// custom_types. Every other top-level key is kept as-is.
+func withoutKinds(data []byte, kinds []string) ([]byte, error) {
+	var model map[string]json.RawMessage
+	if err := json.Unmarshal(data, &model); err != nil {
+		return nil, err
+	}
+
+	var types map[string]json.RawMessage
+	if err := json.Unmarshal(model["custom_types"], &types); err != nil {
+		return nil, err
+	}
+	for _, kind := range kinds {
+		delete(types, kind)
+	}
+
+	encoded, err := json.Marshal(types)
+	if err != nil {
+		return nil, err
+	}
+	model["custom_types"] = encoded
+
+	return json.Marshal(model)
+}
+
+// apiClient holds the HTTP client and session credentials shared by every
+// BloodHound API call, so all requests reuse the same keep-alive pool.
+type apiClient struct {
+	client *http.Client
+
+	// Endpoint URLs and the Authorization value are built once rather
+	// than formatted on every request.
+	loginURL          string
+	logoutURL         string
+	customNodesURL    string
+	customNodesPrefix string
+	authHeader        string
+}
+
+func newAPIClient(baseURL string) *apiClient {
+	transport := http.DefaultTransport.(*http.Transport).Clone()
+	transport.MaxIdleConnsPerHost = maxParallelDeletes
+	transport.DialContext = (&net.Dialer{
+		Timeout:   connectTimeout,
+		KeepAlive: 30 * time.Second,
+	}).DialContext
+
+	apiBase := baseURL + "/api/v2"
+
+	return &apiClient{
+		client: &http.Client{
+			Transport: transport,
+			Timeout:   requestTimeout,
+		},
+		loginURL:          apiBase + "/login",
+		logoutURL:         apiBase + "/logout",
+		customNodesURL:    apiBase + "/custom-nodes",
+		customNodesPrefix: apiBase + "/custom-nodes/",
+	}
+}
+
+// do builds and sends a request with the common headers.
+func (c *apiClient) do(ctx context.Context, method, reqURL string, body []byte) (*http.Response, error) {
+	req, err := c.newRequest(ctx, method, reqURL, body)
+	if err != nil {
+		return nil, err
+	}
+	return c.send(req)
+}
+
+// newRequest builds a request carrying the common headers.
+func (c *apiClient) newRequest(ctx context.Context, method, reqURL string, body []byte) (*http.Request, error) {
+	var reader io.Reader
+	if body != nil {
+		reader = bytes.NewReader(body)
+	}
+
+	req, err := http.NewRequestWithContext(ctx, method, reqURL, reader)
+	if err != nil {
+		return nil, err
+	}
+
+	req.Header.Set("User-Agent", userAgent)
+	req.Header.Set("Accept", "application/json")
+	if body != nil {
+		req.Header.Set("Content-Type", "application/json")
+	}
+	if c.authHeader != "" {
+		req.Header.Set("Authorization", c.authHeader)
+	}
+
+	return req, nil
+}
+
+// send performs the request, retrying transient failures, and returns the
+// response for 2xx statuses. Non-2xx responses are turned into an error.
+//
+// Failed dials are always retried since the request never left the client.
+// Retryable statuses are only retried for idempotent methods: a POST that
+// reached the server may already have been applied. Anything else,
+// including client timeouts and TLS errors, fails immediately.
+func (c *apiClient) send(req *http.Request) (*http.Response, error) {
+	var resp *http.Response
+	var err error
+	start := time.Now()
 
+	for attempt := 0; ; attempt++ {
+		if attempt > 0 && req.GetBody != nil {
+			if req.Body, err = req.GetBody(); err != nil {
+				return nil, err
+			}
+		}
+
+		resp, err = c.client.Do(req)
+		if attempt == maxRetries || req.Context().Err() != nil {
+			break
+		}
+		if err != nil && !retryableError(err) {
+			break
+		}
+		if err == nil && !(idempotent(req.Method) && retryableStatus(resp.StatusCode)) {
+			break
+		}
+
+		wait := retryBackoff << attempt
+		if err == nil {
+			if after := retryAfter(resp); after > 0 {
+				wait = after
+			}
+		}
+		if time.Since(start)+wait > maxRetryElapsed {
+			break
+		}
+		if err == nil {
+			discard(resp)
+		}
+		select {
+		case <-time.After(wait):
+		case <-req.Context().Done():
+			return nil, req.Context().Err()
+		}
+	}
+	if err != nil {
+		return nil, err
+	}
+
+	if resp.StatusCode < 200 || resp.StatusCode >= 300 {
+		defer resp.Body.Close()
+		respBody, _ := io.ReadAll(resp.Body)
+		return nil, fmt.Errorf("status %d: %s", resp.StatusCode, string(respBody))
+	}
+
+	return resp, nil
+}
+
+// retryableError reports whether err is a failure to connect, in which case
+// nothing was sent and any request can safely be repeated.
+func retryableError(err error) bool {
+	var opErr *net.OpError
+	return errors.As(err, &opErr) && opErr.Op == "dial"
+}
+
+func idempotent(method string) bool {
+	switch method {
+	case "GET", "HEAD", "OPTIONS", "PUT", "DELETE":
+		return true
+	}
+	return false
+}
+
+func retryableStatus(code int) bool {
+	switch code {
+	case http.StatusTooManyRequests, http.StatusBadGateway,
+		http.StatusServiceUnavailable, http.StatusGatewayTimeout:
+		return true
+	}
+	return false
+}
+
+// retryAfter returns the delay requested by a Retry-After header given in
+// seconds, capped at maxRetryAfter, or zero if there is none.
+func retryAfter(resp *http.Response) time.Duration {
+	secs, err := strconv.Atoi(resp.Header.Get("Retry-After"))
+	if err != nil || secs < 0 {
+		return 0
+	}
+	if wait := time.Duration(secs) * time.Second; wait < maxRetryAfter {
+		return wait
+	}
+	return maxRetryAfter
+}
+
+// discard drains and closes a response body. The transport only returns a
+// connection to the idle pool once its body has been read to EOF.
+func discard(resp *http.Response) {
+	io.Copy(io.Discard, resp.Body)
+	resp.Body.Close()
+}
+
+func (c *apiClient) login(ctx context.Context, username, password string) error {
 	reqBody := map[string]string{
 		"login_method": "secret",
 		"username":     username,
 		"secret":       password,
 	}
 
-	jsonBody, _ := json.Marshal(reqBody)
-
-	resp, err := client.Post(loginURL, "application/json", bytes.NewBuffer(jsonBody))
+	jsonBody, err := json.Marshal(reqBody)
 	if err != nil {
-		return "", err
+		return err
 	}
-	defer resp.Body.Close()
 
-	if resp.StatusCode != 200 {
-		body, _ := ioutil.ReadAll(resp.Body)
-		return "", fmt.Errorf("status %d: %s", resp.StatusCode, string(body))
+	resp, err := c.do(ctx, "POST", c.loginURL, jsonBody)
+	if err != nil {
+		return err
 	}
+	defer discard(resp)
 
 	var result struct {
 		Data struct {
@@ -106,38 +480,206 @@ func login(client *http.Client, baseURL, username, password string) (string, err
 		} `json:"data"`
 	}
 
+	// Decode straight off the wire instead of buffering the body first.
 	if err := json.NewDecoder(resp.Body).Decode(&result); err != nil {
-		return "", err
+		return fmt.Errorf("invalid login response: %v", err)
 	}
 
 	if result.Data.SessionToken == "" {
-		return "", fmt.Errorf("no session token in response")
+		return fmt.Errorf("no session token in response")
 	}
 
-	return result.Data.SessionToken, nil
+	c.authHeader = "Bearer " + result.Data.SessionToken
+	return nil
 }
 
-func upload(client *http.Client, baseURL, token string, data []byte) error {
-	uploadURL := baseURL + "/api/v2/custom-nodes"
+func (c *apiClient) logout(ctx context.Context) error {
+	resp, err := c.do(ctx, "POST", c.logoutURL, nil)
+	if err != nil {
+		return err
+	}
+	discard(resp)
+
+	return nil
+}
+
+func (c *apiClient) upload(ctx context.Context, data []byte, compress bool) error {
+	if compress {
+		var buf bytes.Buffer
+		// Level 3 keeps most of the ratio on JSON at a fraction of the CPU.
+		zw, err := gzip.NewWriterLevel(&buf, 3)
+		if err != nil {
+			return err
+		}
+		if _, err := zw.Write(data); err != nil {
+			return err
+		}
+		if err := zw.Close(); err != nil {
+			return err
+		}
+		data = buf.Bytes()
+	}
+
+	req, err := c.newRequest(ctx, "POST", c.customNodesURL, data)
+	if err != nil {
+		return err
+	}
+	if compress {
+		req.Header.Set("Content-Encoding", "gzip")
+	}
 
-	req, err := http.NewRequest("POST", uploadURL, bytes.NewBuffer(data))
+	resp, err := c.send(req)
 	if err != nil {
 		return err
 	}
+	discard(resp)
 
-	req.Header.Set("Content-Type", "application/json")
-	req.Header.Set("Authorization", "Bearer "+token)
+	return nil
+}
 
-	resp, err := client.Do(req)
+// eachCustomNodeKind streams the custom node listing and calls fn with each
+// kind name and its config as it is decoded, so the full response is never
+// held in memory.
+func (c *apiClient) eachCustomNodeKind(ctx context.Context, fn func(kind string, config json.RawMessage)) error {
+	resp, err := c.do(ctx, "GET", c.customNodesURL, nil)
 	if err != nil {
 		return err
 	}
-	defer resp.Body.Close()
+	defer discard(resp)
 
-	if resp.StatusCode < 200 || resp.StatusCode >= 300 {
-		body, _ := ioutil.ReadAll(resp.Body)
-		return fmt.Errorf("status %d: %s", resp.StatusCode, string(body))
+	dec := json.NewDecoder(resp.Body)
+	if err := expectDelim(dec, '{'); err != nil {
+		return fmt.Errorf("invalid custom nodes response: %v", err)
+	}
+
+	for dec.More() {
+		key, err := dec.Token()
+		if err != nil {
+			return fmt.Errorf("invalid custom nodes response: %v", err)
+		}
+
+		if key != "data" {
+			var skip json.RawMessage
+			if err := dec.Decode(&skip); err != nil {
+				return fmt.Errorf("invalid custom nodes response: %v", err)
+			}
+			continue
+		}
+
+		// An empty listing may come back as "data": null.
+		tok, err := dec.Token()
+		if err != nil {
+			return fmt.Errorf("invalid custom nodes response: %v", err)
+		}
+		if tok == nil {
+			continue
+		}
+		if tok != json.Delim('[') {
+			return fmt.Errorf("invalid custom nodes response: expected %q, got %v", json.Delim('['), tok)
+		}
+		for dec.More() {
+			var node struct {
+				KindName string          `json:"kindName"`
+				Config   json.RawMessage `json:"config"`
+			}
+			if err := dec.Decode(&node); err != nil {
+				return fmt.Errorf("invalid custom nodes response: %v", err)
+			}
+			if node.KindName != "" {
+				fn(node.KindName, node.Config)
+			}
+		}
+		if err := expectDelim(dec, ']'); err != nil {
+			return fmt.Errorf("invalid custom nodes response: %v", err)
+		}
 	}
 
 	return nil
 }
+
+// expectDelim reads the next token and checks that it is the given delimiter.
+func expectDelim(dec *json.Decoder, want json.Delim) error {
+	tok, err := dec.Token()
+	if err != nil {
+		return err
+	}
+	if tok != want {
+		return fmt.Errorf("expected %q, got %v", want, tok)
+	}
+	return nil
+}
+
+func (c *apiClient) deleteCustomNode(ctx context.Context, kind string) error {
+	resp, err := c.do(ctx, "DELETE", c.customNodesPrefix+url.PathEscape(kind), nil)
+	if err != nil {
+		return err
+	}
+	discard(resp)
+
+	return nil
+}
+
+type resetResult struct {
+	existing int
+	outdated int
+	deleted  int
+	// unchanged lists the existing kinds whose config already matches
+	// the model; they are neither deleted nor uploaded again.
+	unchanged []string
+}
+
+// resetCustomNodes deletes every existing kind that is missing from desired
+// or whose server config differs from it, with at most maxParallelDeletes
+// requests in flight. Names are collected while the listing streams and
+// only dispatched once it has been read, so a slow delete can never stall
+// the listing past the client timeout.
+func (c *apiClient) resetCustomNodes(ctx context.Context, desired map[string]customType) (resetResult, error) {
+	var result resetResult
+	var outdated []string
+	err := c.eachCustomNodeKind(ctx, func(kind string, config json.RawMessage) {
+		result.existing++
+		if def, ok := desired[kind]; ok && sameConfig(def.raw, config) {
+			result.unchanged = append(result.unchanged, kind)
+			return
+		}
+		outdated = append(outdated, kind)
+	})
+	if err != nil {
+		return result, err
+	}
+	result.outdated = len(outdated)
+
+	jobs := make(chan string)
+	var wg sync.WaitGroup
+	var mu sync.Mutex
+
+	workers := maxParallelDeletes
+	if len(outdated) < workers {
+		workers = len(outdated)
+	}
+
+	for i := 0; i < workers; i++ {
+		wg.Add(1)
+		go func() {
+			defer wg.Done()
+			for kind := range jobs {
+				if err := c.deleteCustomNode(ctx, kind); err != nil {
+					// Written directly so failures are reported even with -q.
+					fmt.Fprintf(os.Stderr, "Failed to delete custom node %s: %v\n", kind, err)
+					continue
+				}
+				mu.Lock()
+				result.deleted++
+				mu.Unlock()
+			}
+		}()
+	}
+
+	for _, kind := range outdated {
+		jobs <- kind
+	}
+	close(jobs)
+	wg.Wait()
+
+	return result, nil
+}
@@ -0,0 +1,321 @@
+package main
+
+import (
+	"context"
+	"encoding/json"
+	"errors"
+	"fmt"
+	"io"
+	"net"
+	"net/http"
+	"net/http/httptest"
+	"net/url"
+	"os"
+	"path/filepath"
+	"reflect"
+	"sort"
+	"strings"
+	"sync"
+	"testing"
+	"time"
+)
+
+func TestSend(t *testing.T) {
+	tests := []struct {
+		name     string
+		method   string
+		body     string
+		statuses []int
+		wantHits int
+		wantErr  bool
+	}{
+		{name: "success", method: "GET", statuses: []int{200}, wantHits: 1},
+		{name: "retryable GET", method: "GET", statuses: []int{503, 502, 200}, wantHits: 3},
+		{name: "retryable DELETE", method: "DELETE", statuses: []int{429, 200}, wantHits: 2},
+		{name: "PUT body replayed", method: "PUT", body: `{"a":1}`, statuses: []int{504, 200}, wantHits: 2},
+		{name: "non-retryable", method: "GET", statuses: []int{400}, wantHits: 1, wantErr: true},
+		{name: "server error not retried", method: "GET", statuses: []int{500}, wantHits: 1, wantErr: true},
+		{name: "POST not replayed", method: "POST", body: `{"a":1}`, statuses: []int{503, 200}, wantHits: 1, wantErr: true},
+	}
+
+	for _, tt := range tests {
+		t.Run(tt.name, func(t *testing.T) {
+			var mu sync.Mutex
+			var bodies []string
+			srv := httptest.NewServer(http.HandlerFunc(func(w http.ResponseWriter, r *http.Request) {
+				b, _ := io.ReadAll(r.Body)
+				mu.Lock()
+				bodies = append(bodies, string(b))
+				status := tt.statuses[len(bodies)-1]
+				mu.Unlock()
+				w.WriteHeader(status)
+			}))
+			defer srv.Close()
+
+			var body []byte
+			if tt.body != "" {
+				body = []byte(tt.body)
+			}
+			resp, err := newAPIClient(srv.URL).do(context.Background(), tt.method, srv.URL, body)
+			if (err != nil) != tt.wantErr {
+				t.Fatalf("err = %v, wantErr %v", err, tt.wantErr)
+			}
+			if err == nil {
+				discard(resp)
+			}
+			if len(bodies) != tt.wantHits {
+				t.Errorf("hits = %d, want %d", len(bodies), tt.wantHits)
+			}
+			for i, b := range bodies {
+				if b != tt.body {
+					t.Errorf("attempt %d body = %q, want %q", i, b, tt.body)
+				}
+			}
+		})
+	}
+}
+
+func TestRetryableError(t *testing.T) {
+	dialErr := &net.OpError{Op: "dial", Net: "tcp", Err: errors.New("connection refused")}
+
+	tests := []struct {
+		name string
+		err  error
+		want bool
+	}{
+		{name: "dial", err: dialErr, want: true},
+		{name: "wrapped dial", err: &url.Error{Op: "Post", URL: "http://x", Err: dialErr}, want: true},
+		{name: "read", err: &url.Error{Op: "Get", URL: "http://x", Err: &net.OpError{Op: "read", Err: errors.New("reset")}}},
+		{name: "client timeout", err: &url.Error{Op: "Get", URL: "http://x", Err: context.DeadlineExceeded}},
+		{name: "other", err: fmt.Errorf("x509: certificate signed by unknown authority")},
+	}
+
+	for _, tt := range tests {
+		t.Run(tt.name, func(t *testing.T) {
+			if got := retryableError(tt.err); got != tt.want {
+				t.Errorf("retryableError(%v) = %v, want %v", tt.err, got, tt.want)
+			}
+		})
+	}
+}
+
+func TestRetryAfter(t *testing.T) {
+	tests := []struct {
+		header string
+		want   time.Duration
+	}{
+		{"", 0},
+		{"abc", 0},
+		{"-1", 0},
+		{"0", 0},
+		{"2", 2 * time.Second},
+		{"3600", maxRetryAfter},
+	}
+
+	for _, tt := range tests {
+		resp := &http.Response{Header: http.Header{"Retry-After": []string{tt.header}}}
+		if got := retryAfter(resp); got != tt.want {
+			t.Errorf("retryAfter(%q) = %v, want %v", tt.header, got, tt.want)
+		}
+	}
+}
+
+func TestEachCustomNodeKind(t *testing.T) {
+	tests := []struct {
+		name    string
+		body    string
+		want    []string
+		wantErr bool
+	}{
+		{name: "null data", body: `{"data": null}`},
+		{name: "empty data", body: `{"data": []}`},
+		{name: "missing data", body: `{}`},
+		{
+			name: "kinds",
+			body: `{"data": [{"id": 1, "kindName": "A", "config": {"icon": {}}}, {"kindName": "B"}]}`,
+			want: []string{"A", "B"},
+		},
+		{
+			name: "extra keys around data",
+			body: `{"count": 2, "meta": {"x": [1, {"kindName": "no"}]}, "data": [{"kindName": "A"}], "tail": null}`,
+			want: []string{"A"},
+		},
+		{
+			name: "empty kind name skipped",
+			body: `{"data": [{"kindName": ""}, {"kindName": "A"}]}`,
+			want: []string{"A"},
+		},
+		{name: "data not an array", body: `{"data": 5}`, wantErr: true},
+		{name: "not an object", body: `[]`, wantErr: true},
+		{name: "truncated", body: `{"data": [{"kindName": "A"}`, wantErr: true},
+	}
+
+	for _, tt := range tests {
+		t.Run(tt.name, func(t *testing.T) {
+			srv := httptest.NewServer(http.HandlerFunc(func(w http.ResponseWriter, r *http.Request) {
+				w.Write([]byte(tt.body))
+			}))
+			defer srv.Close()
+
+			var got []string
+			err := newAPIClient(srv.URL).eachCustomNodeKind(context.Background(), func(kind string, _ json.RawMessage) {
+				got = append(got, kind)
+			})
+			if (err != nil) != tt.wantErr {
+				t.Fatalf("err = %v, wantErr %v", err, tt.wantErr)
+			}
+			if !tt.wantErr && !reflect.DeepEqual(got, tt.want) {
+				t.Errorf("kinds = %v, want %v", got, tt.want)
+			}
+		})
+	}
+}
+
+func TestResetCustomNodes(t *testing.T) {
+	desired, err := modelKinds([]byte(`{"custom_types": {
+		"Same":    {"icon": {"type": "font-awesome", "name": "server", "color": "#fff"}},
+		"Changed": {"icon": {"type": "font-awesome", "name": "server", "color": "#000"}},
+		"New":     {"icon": {"type": "font-awesome", "name": "user"}}
+	}}`))
+	if err != nil {
+		t.Fatal(err)
+	}
+
+	var mu sync.Mutex
+	var deleted []string
+	srv := httptest.NewServer(http.HandlerFunc(func(w http.ResponseWriter, r *http.Request) {
+		switch r.Method {
+		case "GET":
+			w.Write([]byte(`{"data": [
+				{"kindName": "Same", "config": {"icon": {"color": "#fff", "name": "server", "type": "font-awesome"}}},
+				{"kindName": "Changed", "config": {"icon": {"type": "font-awesome", "name": "server", "color": "#fff"}}},
+				{"kindName": "Stale", "config": {"icon": {"type": "font-awesome", "name": "box"}}}
+			]}`))
+		case "DELETE":
+			mu.Lock()
+			deleted = append(deleted, strings.TrimPrefix(r.URL.Path, "/api/v2/custom-nodes/"))
+			mu.Unlock()
+		}
+	}))
+	defer srv.Close()
+
+	result, err := newAPIClient(srv.URL).resetCustomNodes(context.Background(), desired)
+	if err != nil {
+		t.Fatal(err)
+	}
+
+	sort.Strings(deleted)
+	if want := []string{"Changed", "Stale"}; !reflect.DeepEqual(deleted, want) {
+		t.Errorf("deleted = %v, want %v", deleted, want)
+	}
+	if want := []string{"Same"}; !reflect.DeepEqual(result.unchanged, want) {
+		t.Errorf("unchanged = %v, want %v", result.unchanged, want)
+	}
+	if result.existing != 3 || result.outdated != 2 || result.deleted != 2 {
+		t.Errorf("result = %+v", result)
+	}
+}
+
+func TestWithoutKinds(t *testing.T) {
+	got, err := withoutKinds([]byte(`{"custom_types": {"A": {"icon": {}}, "B": {"icon": {}}}, "metadata": {"v": 1}}`), []string{"A"})
+	if err != nil {
+		t.Fatal(err)
+	}
+
+	var model struct {
+		CustomTypes map[string]json.RawMessage `json:"custom_types"`
+		Metadata    json.RawMessage            `json:"metadata"`
+	}
+	if err := json.Unmarshal(got, &model); err != nil {
+		t.Fatal(err)
+	}
+	if _, ok := model.CustomTypes["A"]; ok || len(model.CustomTypes) != 1 {
+		t.Errorf("custom_types = %s", got)
+	}
+	if string(model.Metadata) != `{"v":1}` {
+		t.Errorf("metadata = %s", model.Metadata)
+	}
+}
+
+func TestUploadSchemaFailsOnPartialReset(t *testing.T) {
+	modelPath := filepath.Join(t.TempDir(), "model.json")
+	model := `{"custom_types": {"A": {"icon": {"type": "font-awesome", "name": "server"}}}}`
+	if err := os.WriteFile(modelPath, []byte(model), 0o644); err != nil {
+		t.Fatal(err)
+	}
+
+	var mu sync.Mutex
+	uploaded := false
+	srv := httptest.NewServer(http.HandlerFunc(func(w http.ResponseWriter, r *http.Request) {
+		switch {
+		case r.URL.Path == "/api/v2/login":
+			w.Write([]byte(`{"data": {"session_token": "tok"}}`))
+		case r.Method == "GET":
+			w.Write([]byte(`{"data": [{"kindName": "Stale"}]}`))
+		case r.Method == "DELETE":
+			w.WriteHeader(http.StatusBadRequest)
+		case r.URL.Path == "/api/v2/custom-nodes":
+			mu.Lock()
+			uploaded = true
+			mu.Unlock()
+		}
+	}))
+	defer srv.Close()
+
+	err := UploadSchema(context.Background(), srv.URL, "u", "p", modelPath, UploadOptions{Reset: true})
+	if err == nil {
+		t.Fatal("expected an error when a delete fails")
+	}
+	if uploaded {
+		t.Error("model was uploaded after a failed reset")
+	}
+}
+
+func TestModelKinds(t *testing.T) {
+	tests := []struct {
+		name    string
+		model   string
+		want    []string
+		wantErr string
+	}{
+		{
+			name:  "valid",
+			model: `{"custom_types": {"A": {"icon": {"type": "font-awesome", "name": "server", "color": "#fff"}}, "B": {"icon": {"type": "font-awesome", "name": "user"}}}, "metadata": {}}`,
+			want:  []string{"A", "B"},
+		},
+		{name: "invalid JSON", model: `{"custom_types":`, wantErr: "unexpected end"},
+		{name: "missing custom_types", model: `{"metadata": {}}`, wantErr: "custom_types is missing or empty"},
+		{name: "empty custom_types", model: `{"custom_types": {}}`, wantErr: "custom_types is missing or empty"},
+		{name: "wrong shape", model: `{"custom_types": []}`, wantErr: "cannot unmarshal"},
+		{name: "empty kind name", model: `{"custom_types": {"": {"icon": {"type": "t", "name": "n"}}}}`, wantErr: "empty kind name"},
+		{name: "missing icon type", model: `{"custom_types": {"A": {"icon": {"name": "n"}}}}`, wantErr: "custom_types.A.icon.type is required"},
+		{name: "missing icon name", model: `{"custom_types": {"A": {"icon": {"type": "t"}}}}`, wantErr: "custom_types.A.icon.name is required"},
+	}
+
+	for _, tt := range tests {
+		t.Run(tt.name, func(t *testing.T) {
+			kinds, err := modelKinds([]byte(tt.model))
+			if tt.wantErr != "" {
+				if err == nil || !strings.Contains(err.Error(), tt.wantErr) {
+					t.Fatalf("err = %v, want %q", err, tt.wantErr)
+				}
+				return
+			}
+			if err != nil {
+				t.Fatal(err)
+			}
+
+			var got []string
+			for kind, def := range kinds {
+				got = append(got, kind)
+				if len(def.raw) == 0 {
+					t.Errorf("kind %s has no raw definition", kind)
+				}
+			}
+			sort.Strings(got)
+			if !reflect.DeepEqual(got, tt.want) {
+				t.Errorf("kinds = %v, want %v", got, tt.want)
+			}
+		})
+	}
+}